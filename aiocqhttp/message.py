@@ -3,7 +3,6 @@
 """
 
 import sys
-import re
 from typing import Iterable, Dict, Tuple, Any, Optional, Union
 
 from .typing import Message_T
@@ -12,12 +11,22 @@ from .typing import Message_T
 __pdoc__ = {}
 
 
+# characters allowed in CQ code function names and parameter keys
+_CQ_NAME_CHARS = frozenset('-._0123456789'
+                           'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                           'abcdefghijklmnopqrstuvwxyz')
+
+
 def escape(s: str, *, escape_comma: bool = True) -> str:
     """
     对字符串进行 CQ 码转义。
 
     ``escape_comma`` 参数控制是否转义逗号（``,``）。
     """
+    if '&' not in s and '[' not in s and ']' not in s and \
+            (not escape_comma or ',' not in s):
+        # plain text is by far the most common case
+        return s
     s = s.replace('&', '&amp;') \
         .replace('[', '&#91;') \
         .replace(']', '&#93;')
@@ -28,16 +37,21 @@ def escape(s: str, *, escape_comma: bool = True) -> str:
 
 def unescape(s: str) -> str:
     """对字符串进行 CQ 码去转义。"""
+    if '&' not in s:
+        return s
     return s.replace('&#44;', ',') \
         .replace('&#91;', '[') \
         .replace('&#93;', ']') \
         .replace('&amp;', '&')
 
 
+_B2S = ('0', '1')
+
+
 def _optionally_strfy(x: Optional[Any]) -> Optional[str]:
     if x is not None:
         if isinstance(x, bool):
-            x = int(x)  # turn boolean to 0/1
+            return _B2S[x]  # turn boolean to 0/1
         x = str(x)
     return x
 
@@ -50,6 +64,75 @@ def _remove_optional(d: Dict[str, Optional[str]]) -> Dict[str, str]:
     return d  # type: ignore
 
 
+def _parse_cq_code(code: str) -> Optional[Tuple[str, Dict[str, str]]]:
+    """
+    解析 CQ 码方括号内 ``CQ:`` 之后的部分，即 ``type,k1=v1,k2=v2``。
+
+    格式不合法时返回 ``None``。
+    """
+    type_, _, params = code.partition(',')
+    if not type_ or not _CQ_NAME_CHARS.issuperset(type_):
+        return None
+
+    data = {}
+    if params:
+        params = params.split(',')
+        if not params[-1]:
+            # a trailing comma is allowed
+            params.pop()
+        for param in params:
+            k, sep, v = param.partition('=')
+            if not sep or not k or not _CQ_NAME_CHARS.issuperset(k):
+                return None
+            data[k] = unescape(v)
+    return type_, data
+
+
+def _match_cq_code(s: str) -> Optional[Tuple[int, str, Dict[str, str]]]:
+    """
+    在以 ``[CQ:`` 开头、不含 ``]`` 的字符串中查找最靠左的合法 CQ 码（不含结尾的
+    ``]``），返回其起始位置、类型和参数。
+
+    找不到时返回 ``None``。
+    """
+    cqcode = _parse_cq_code(s[4:])
+    if cqcode is not None:
+        return (0, *cqcode)
+    if s.find('[CQ:', 4) < 0:
+        return None
+
+    # every "[CQ:" in s ends at the same "]", and a CQ code beginning inside
+    # a comma-separated piece shares all the following pieces as parameters,
+    # so validating each piece once keeps this linear in the length of s
+    pieces = s.split(',')
+    n = len(pieces)
+    # params_ok[i]: pieces[i:] are all valid parameters
+    params_ok = [True] * (n + 1)
+    for i in range(n - 1, 0, -1):
+        if i == n - 1 and not pieces[i]:
+            # a trailing comma is allowed
+            continue
+        k, sep, _ = pieces[i].partition('=')
+        params_ok[i] = params_ok[i + 1] and bool(sep) and bool(k) and \
+            _CQ_NAME_CHARS.issuperset(k)
+
+    piece_begin = 0
+    for i, piece in enumerate(pieces):
+        # only the last "[CQ:" in a piece may have a type without "["
+        offset = piece.rfind('[CQ:')
+        if offset >= 0 and params_ok[i + 1]:
+            type_ = piece[offset + 4:]
+            if type_ and _CQ_NAME_CHARS.issuperset(type_):
+                data = {}
+                for param in pieces[i + 1:]:
+                    if param:
+                        k, _, v = param.partition('=')
+                        data[k] = unescape(v)
+                return piece_begin + offset, type_, data
+        piece_begin += len(piece) + 1
+    return None
+
+
 class MessageSegment(dict):
     """
     消息段，即表示成字典的 CQ 码。
@@ -89,6 +172,13 @@ class MessageSegment(dict):
         else:
             raise ValueError('the "type" field cannot be None or empty')
 
+    @classmethod
+    def _make(cls, type_: str, data: Dict[str, str]) -> 'MessageSegment':
+        """不经检查直接构造消息段，仅在参数已知合法时使用。"""
+        seg = dict.__new__(cls)
+        dict.update(seg, type=type_, data=data)
+        return seg
+
     def __getitem__(self, item):
         if item not in ('type', 'data'):
             raise KeyError(f'the key "{item}" is not allowed')
@@ -109,11 +199,11 @@ class MessageSegment(dict):
 
         纯文本消息段的类型名为 ``text``。
         """
-        return self['type']
+        return dict.__getitem__(self, 'type')
 
     @type.setter
     def type(self, type_: str):
-        self['type'] = type_
+        dict.__setitem__(self, 'type', type_)
 
     @property
     def data(self) -> Dict[str, str]:
@@ -122,22 +212,22 @@ class MessageSegment(dict):
 
         该字典内所有值都是未经 CQ 码转义的字符串。
         """
-        return self['data']
+        return dict.__getitem__(self, 'data')
 
     @data.setter
     def data(self, data: Optional[Dict[str, str]]):
-        self['data'] = data or {}
+        dict.__setitem__(self, 'data', data or {})
 
     def __str__(self):
         """将消息段转换成字符串格式。"""
-        if self.type == 'text':
-            return escape(self.data.get('text', ''), escape_comma=False)
+        type_, data = self.type, self.data
+        if type_ == 'text':
+            return escape(data.get('text', ''), escape_comma=False)
 
-        params = ','.join(
-            ('{}={}'.format(k, escape(str(v))) for k, v in self.data.items()))
-        if params:
-            params = ',' + params
-        return '[CQ:{type}{params}]'.format(type=self.type, params=params)
+        if not data:
+            return f'[CQ:{type_}]'
+        params = ','.join([f'{k}={escape(str(v))}' for k, v in data.items()])
+        return f'[CQ:{type_},{params}]'
 
     __pdoc__['MessageSegment.__str__'] = True
 
@@ -182,17 +272,17 @@ class MessageSegment(dict):
     @staticmethod
     def text(text: str) -> 'MessageSegment':
         """纯文本。"""
-        return MessageSegment(type_='text', data={'text': text})
+        return MessageSegment._make('text', {'text': text})
 
     @staticmethod
     def emoji(id_: int) -> 'MessageSegment':
         """Emoji 表情。"""
-        return MessageSegment(type_='emoji', data={'id': str(id_)})
+        return MessageSegment._make('emoji', {'id': str(id_)})
 
     @staticmethod
     def face(id_: int) -> 'MessageSegment':
         """QQ 表情。"""
-        return MessageSegment(type_='face', data={'id': str(id_)})
+        return MessageSegment._make('face', {'id': str(id_)})
 
     @staticmethod
     def image(file: str,
@@ -203,15 +293,14 @@ class MessageSegment(dict):
               timeout: Optional[int] = None) -> 'MessageSegment':
         """图片。"""
         # NOTE: destruct parameter is not part of the onebot v11 std.
-        return MessageSegment(type_='image',
-                              data=_remove_optional({
-                                      'file': file,
-                                      'type': _optionally_strfy(type),
-                                      'cache': _optionally_strfy(cache),
-                                      'proxy': _optionally_strfy(proxy),
-                                      'timeout': _optionally_strfy(timeout),
-                                      'destruct': _optionally_strfy(destruct),
-                              }))
+        return MessageSegment._make('image', _remove_optional({
+            'file': file,
+            'type': _optionally_strfy(type),
+            'cache': _optionally_strfy(cache),
+            'proxy': _optionally_strfy(proxy),
+            'timeout': _optionally_strfy(timeout),
+            'destruct': _optionally_strfy(destruct),
+        }))
 
     @staticmethod
     def record(file: str,
@@ -220,14 +309,13 @@ class MessageSegment(dict):
                proxy: Optional[bool] = None,
                timeout: Optional[int] = None) -> 'MessageSegment':
         """语音。"""
-        return MessageSegment(type_='record',
-                              data=_remove_optional({
-                                  'file': file,
-                                  'magic': _optionally_strfy(magic),
-                                  'cache': _optionally_strfy(cache),
-                                  'proxy': _optionally_strfy(proxy),
-                                  'timeout': _optionally_strfy(timeout),
-                              }))
+        return MessageSegment._make('record', _remove_optional({
+            'file': file,
+            'magic': _optionally_strfy(magic),
+            'cache': _optionally_strfy(cache),
+            'proxy': _optionally_strfy(proxy),
+            'timeout': _optionally_strfy(timeout),
+        }))
 
     @staticmethod
     def video(file: str,
@@ -235,50 +323,47 @@ class MessageSegment(dict):
               proxy: Optional[bool] = None,
               timeout: Optional[int] = None) -> 'MessageSegment':
         """短视频。"""
-        return MessageSegment(type_='video',
-                              data=_remove_optional({
-                                  'file': file,
-                                  'cache': _optionally_strfy(cache),
-                                  'proxy': _optionally_strfy(proxy),
-                                  'timeout': _optionally_strfy(timeout),
-                              }))
+        return MessageSegment._make('video', _remove_optional({
+            'file': file,
+            'cache': _optionally_strfy(cache),
+            'proxy': _optionally_strfy(proxy),
+            'timeout': _optionally_strfy(timeout),
+        }))
 
     @staticmethod
     def at(user_id: Union[int, str]) -> 'MessageSegment':
         """@某人。"""
-        return MessageSegment(type_='at', data={'qq': str(user_id)})
+        return MessageSegment._make('at', {'qq': str(user_id)})
 
     @staticmethod
     def rps() -> 'MessageSegment':
         """猜拳魔法表情。"""
-        return MessageSegment(type_='rps')
+        return MessageSegment._make('rps', {})
 
     @staticmethod
     def dice() -> 'MessageSegment':
         """掷骰子魔法表情。"""
-        return MessageSegment(type_='dice')
+        return MessageSegment._make('dice', {})
 
     @staticmethod
     def shake() -> 'MessageSegment':
         """戳一戳（窗口抖动）。"""
-        return MessageSegment(type_='shake')
+        return MessageSegment._make('shake', {})
 
     @staticmethod
     def poke(type_: str, id_: int) -> 'MessageSegment':
         """戳一戳。"""
-        return MessageSegment(type_='poke',
-                              data={
-                                'type': type_,
-                                'id': str(id_),
-                              })
+        return MessageSegment._make('poke', {
+            'type': type_,
+            'id': str(id_),
+        })
 
     @staticmethod
     def anonymous(ignore_failure: Optional[bool] = False) -> 'MessageSegment':
         """匿名发消息。"""
-        return MessageSegment(type_='anonymous',
-                              data=_remove_optional({
-                                  'ignore': _optionally_strfy(ignore_failure),
-                              }))
+        return MessageSegment._make('anonymous', _remove_optional({
+            'ignore': _optionally_strfy(ignore_failure),
+        }))
 
     @staticmethod
     def share(url: str,
@@ -286,31 +371,28 @@ class MessageSegment(dict):
               content: Optional[str] = None,
               image_url: Optional[str] = None) -> 'MessageSegment':
         """链接分享。"""
-        return MessageSegment(type_='share',
-                              data=_remove_optional({
-                                  'url': url,
-                                  'title': title,
-                                  'content': content,
-                                  'image': image_url,
-                              }))
+        return MessageSegment._make('share', _remove_optional({
+            'url': url,
+            'title': title,
+            'content': content,
+            'image': image_url,
+        }))
 
     @staticmethod
     def contact_user(id_: int) -> 'MessageSegment':
         """推荐好友。"""
-        return MessageSegment(type_='contact',
-                              data={
-                                  'type': 'qq',
-                                  'id': str(id_)
-                              })
+        return MessageSegment._make('contact', {
+            'type': 'qq',
+            'id': str(id_)
+        })
 
     @staticmethod
     def contact_group(id_: int) -> 'MessageSegment':
         """推荐群。"""
-        return MessageSegment(type_='contact',
-                              data={
-                                  'type': 'group',
-                                  'id': str(id_)
-                              })
+        return MessageSegment._make('contact', {
+            'type': 'group',
+            'id': str(id_)
+        })
 
     @staticmethod
     def location(latitude: float,
@@ -318,13 +400,12 @@ class MessageSegment(dict):
                  title: Optional[str] = None,
                  content: Optional[str] = None) -> 'MessageSegment':
         """位置。"""
-        return MessageSegment(type_='location',
-                              data=_remove_optional({
-                                  'lat': str(latitude),
-                                  'lon': str(longitude),
-                                  'title': title,
-                                  'content': content,
-                              }))
+        return MessageSegment._make('location', _remove_optional({
+            'lat': str(latitude),
+            'lon': str(longitude),
+            'title': title,
+            'content': content,
+        }))
 
     @staticmethod
     def music(type_: str,
@@ -332,12 +413,11 @@ class MessageSegment(dict):
               style: Optional[int] = None) -> 'MessageSegment':
         """音乐"""
         # NOTE: style parameter is not part of the onebot v11 std.
-        return MessageSegment(type_='music',
-                              data=_remove_optional({
-                                  'type': type_,
-                                  'id': str(id_),
-                                  'style': _optionally_strfy(style),
-                              }))
+        return MessageSegment._make('music', _remove_optional({
+            'type': type_,
+            'id': str(id_),
+            'style': _optionally_strfy(style),
+        }))
 
     @staticmethod
     def music_custom(url: str,
@@ -346,30 +426,29 @@ class MessageSegment(dict):
                      content: Optional[str] = None,
                      image_url: Optional[str] = None) -> 'MessageSegment':
         """音乐自定义分享。"""
-        return MessageSegment(type_='music',
-                              data=_remove_optional({
-                                  'type': 'custom',
-                                  'url': url,
-                                  'audio': audio_url,
-                                  'title': title,
-                                  'content': content,
-                                  'image': image_url,
-                              }))
+        return MessageSegment._make('music', _remove_optional({
+            'type': 'custom',
+            'url': url,
+            'audio': audio_url,
+            'title': title,
+            'content': content,
+            'image': image_url,
+        }))
 
     @staticmethod
     def reply(id_: int) -> 'MessageSegment':
         """回复时引用消息。"""
-        return MessageSegment(type_='reply', data={'id': str(id_)})
+        return MessageSegment._make('reply', {'id': str(id_)})
 
     @staticmethod
     def forward(id_: int) -> 'MessageSegment':
         """合并转发。注意：此消息只能被接收！"""
-        return MessageSegment(type_='forward', data={'id': str(id_)})
+        return MessageSegment._make('forward', {'id': str(id_)})
 
     @staticmethod
     def node(id_: int) -> 'MessageSegment':
         """合并转发节点。"""
-        return MessageSegment(type_='node', data={'id': str(id_)})
+        return MessageSegment._make('node', {'id': str(id_)})
 
     @staticmethod
     def node_custom(user_id: int,
@@ -378,7 +457,7 @@ class MessageSegment(dict):
         """合并转发自定义节点。"""
         if not isinstance(content, (str, MessageSegment, Message)):
             content = Message(content)
-        return MessageSegment(type_='node', data={
+        return MessageSegment._make('node', {
             'user_id': str(user_id),
             'nickname': nickname,
             'content': str(content),
@@ -387,12 +466,12 @@ class MessageSegment(dict):
     @staticmethod
     def xml(data: str) -> 'MessageSegment':
         """XML 消息。"""
-        return MessageSegment(type_='xml', data={'data': data})
+        return MessageSegment._make('xml', {'data': data})
 
     @staticmethod
     def json(data: str) -> 'MessageSegment':
         """JSON 消息。"""
-        return MessageSegment(type_='json', data={'data': data})
+        return MessageSegment._make('json', {'data': data})
 
 
 class Message(list):
@@ -414,38 +493,49 @@ class Message(list):
         elif msg is not None:
             raise ValueError('the msg argument is not recognized')
 
+    @classmethod
+    def _from_segments(cls, segs: Iterable[MessageSegment]) -> 'Message':
+        """不经检查直接由消息段构造消息，仅在消息段已知合法时使用。"""
+        msg = cls.__new__(cls)
+        list.__init__(msg, segs)
+        return msg
+
     @staticmethod
     def _split_iter(msg_str: str) -> Iterable[MessageSegment]:
-
-        def iter_function_name_and_extra() -> Iterable[Tuple[str, str]]:
-            text_begin = 0
-            for cqcode in re.finditer(
-                    r'\[CQ:(?P<type>[a-zA-Z0-9-_.]+)'
-                    r'(?P<params>'
-                    r'(?:,[a-zA-Z0-9-_.]+=[^,\]]*)*'
-                    r'),?\]',
-                    msg_str,
-            ):
-                yield 'text', msg_str[text_begin:cqcode.pos + cqcode.start()]
-                text_begin = cqcode.pos + cqcode.end()
-                yield cqcode.group('type'), cqcode.group('params').lstrip(',')
-            yield 'text', msg_str[text_begin:]
-
-        for function_name, extra in iter_function_name_and_extra():
-            if function_name == 'text':
-                if extra:
-                    # only yield non-empty text segment
-                    yield MessageSegment(type_=function_name,
-                                         data={'text': unescape(extra)})
-            else:
-                data = {
-                    k: unescape(v) for k, v in map(
-                        lambda x: x.split('=', maxsplit=1),
-                        filter(lambda x: x, (
-                            x.lstrip() for x in extra.split(','))),
-                    )
-                }
-                yield MessageSegment(type_=function_name, data=data)
+        if '[CQ:' not in msg_str:
+            # most messages are plain text
+            if msg_str:
+                yield MessageSegment._make('text', {'text': unescape(msg_str)})
+            return
+
+        text_begin = 0
+        pos = 0
+        while True:
+            start = msg_str.find('[CQ:', pos)
+            if start < 0:
+                break
+            # parameter values cannot contain "]", so a CQ code, if any,
+            # always ends at the first "]" after its beginning
+            end = msg_str.find(']', start + 4)
+            if end < 0:
+                break
+            cqcode = _match_cq_code(msg_str[start:end])
+            pos = end + 1
+            if cqcode is None:
+                continue
+
+            offset, type_, data = cqcode
+            start += offset
+            if start > text_begin:
+                # only yield non-empty text segment
+                yield MessageSegment._make(
+                    'text', {'text': unescape(msg_str[text_begin:start])})
+            yield MessageSegment._make(type_, data)
+            text_begin = pos
+
+        if text_begin < len(msg_str):
+            yield MessageSegment._make(
+                'text', {'text': unescape(msg_str[text_begin:])})
 
     def __str__(self):
         """将消息转换成字符串格式。"""
@@ -468,7 +558,7 @@ class Message(list):
         elif isinstance(other, dict):
             self.append(MessageSegment(other))
         elif isinstance(other, str):
-            self.extend(Message._split_iter(other))
+            self.extend(other)
         else:
             raise ValueError('the addend is not a message')
         return self
@@ -481,7 +571,18 @@ class Message(list):
 
         当 ``other`` 不是合法的消息（段）时，抛出 ``ValueError``。
         """
-        result = Message(self)
+        # segments of self are already valid, only other has to be checked
+        result = Message._from_segments(self)
+        if result and result[-1].type == 'text':
+            # text may be merged into the last segment, which must not be the
+            # one shared with self
+            result[-1] = MessageSegment._make('text', result[-1].data.copy())
+        if isinstance(other, str) and '[CQ:' not in other:
+            # plain text, no need to go through the parser
+            if other:
+                result.append(
+                    MessageSegment._make('text', {'text': unescape(other)}))
+            return result
         result.__iadd__(other)
         return result
 
@@ -507,15 +608,14 @@ class Message(list):
 
         当 ``obj`` 不是一个能够被识别的消息段时，抛出 ``ValueError``。
         """
-        if isinstance(obj, MessageSegment):
-            if self and self[-1].type == 'text' and obj.type == 'text':
-                self[-1].data['text'] += obj.data['text']
-            elif obj.type != 'text' or obj.data['text'] or not self:
-                super().append(obj)
-            else:
-                raise ValueError('the object is not a proper message segment')
+        if not isinstance(obj, MessageSegment):
+            obj = MessageSegment(obj)
+        if self and self[-1].type == 'text' and obj.type == 'text':
+            self[-1].data['text'] += obj.data['text']
+        elif obj.type != 'text' or obj.data['text'] or not self:
+            super().append(obj)
         else:
-            self.append(MessageSegment(obj))
+            raise ValueError('the object is not a proper message segment')
         return self
 
     def extend(self, msg: Iterable[Any]) -> 'Message':
@@ -525,10 +625,39 @@ class Message(list):
         当 ``msg`` 不是一个能够被识别的消息时，抛出 ``ValueError``。
         """
         if isinstance(msg, str):
-            msg = self._split_iter(msg)
-
+            # segments parsed from a string are always valid and never
+            # contain adjacent text segments, so only the first one may need
+            # to be merged into the current message
+            segs = list(self._split_iter(msg))
+            if segs and self and self[-1].type == 'text' == segs[0].type:
+                self[-1].data['text'] += segs[0].data['text']
+                del segs[0]
+            super().extend(segs)
+            return self
+
+        # build the new segments locally and coalesce adjacent text segments
+        # in one go, instead of dispatching to append() for every segment
+        out = []
+        last = self[-1] if self else None
+        pending_text = []
         for seg in msg:
-            self.append(seg)
+            if not isinstance(seg, MessageSegment):
+                seg = MessageSegment(seg)
+            if seg.type == 'text':
+                if last is not None and last.type == 'text':
+                    pending_text.append(seg.data['text'])
+                    continue
+                if not seg.data['text'] and (self or out):
+                    raise ValueError(
+                        'the object is not a proper message segment')
+            if pending_text:
+                last.data['text'] += ''.join(pending_text)
+                pending_text.clear()
+            out.append(seg)
+            last = seg
+        if pending_text:
+            last.data['text'] += ''.join(pending_text)
+        super().extend(out)
         return self
 
     def reduce(self) -> None:
@@ -537,14 +666,18 @@ class Message(list):
 
         由于 `Message` 类基于 `list`，此方法时间复杂度为 O(n)。
         """
-        idx = 0
-        while idx < len(self):
-            if idx > 0 and \
-                    self[idx - 1].type == 'text' and self[idx].type == 'text':
-                self[idx - 1].data['text'] += self[idx].data['text']
-                del self[idx]
+        # rebuild the list in one pass, deleting merged segments in place
+        # would shift the tail of the list every time
+        segs = []
+        prev_type = None
+        for seg in self:
+            seg_type = seg.type
+            if prev_type == 'text' == seg_type:
+                segs[-1].data['text'] += seg.data['text']
             else:
-                idx += 1
+                segs.append(seg)
+                prev_type = seg_type
+        self[:] = segs
 
     def extract_plain_text(self, reduce: bool = False) -> str:
         """
@@ -555,10 +688,5 @@ class Message(list):
         if reduce:
             self.reduce()
 
-        result = ''
-        for seg in self:
-            if seg.type == 'text':
-                result += ' ' + seg.data['text']
-        if result:
-            result = result[1:]
-        return result
+        return ' '.join(
+            [seg.data['text'] for seg in self if seg.type == 'text'])